@@ -1,57 +1,251 @@
+import asyncio
 import json
 import logging
+import os
+import sys
+from typing import Dict
+from uuid import UUID
 
-from piece_move import PieceMove
-from utils import GetValueEnum
+import websockets
+
+from piece_move import InvalidMove, PieceMove
+from rate_limit import TokenBucket
+from utils import GetValueEnum, get_message
 
 logger = logging.getLogger(__name__)
 
+MAX_MESSAGE_SIZE = int(os.environ.get("MAX_MESSAGE_SIZE", 4096))
+RATE_LIMIT_RATE = float(os.environ.get("RATE_LIMIT_RATE", 5))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", 20))
+MAX_USER_ID_LENGTH = 64
+MAX_TOTAL_LENGTH = 60 * 60 * 3
+MAX_PER_MOVE = 60 * 5
+MAX_PATH_LENGTH = 64
+MAX_SUBSCRIPTIONS = int(os.environ.get("MAX_SUBSCRIPTIONS", 50))
+
 
 class ClientAction(GetValueEnum):
     CONNECT = "CONNECT"
     MOVE = "MOVE"
     IDENTIFY = "IDENTIFY"
     SETTING = "SETTING"
+    HISTORY = "HISTORY"
+    PREMOVE = "PREMOVE"
+    QUEUE = "QUEUE"
+    SUBSCRIBE = "SUBSCRIBE"
+    UNSUBSCRIBE = "UNSUBSCRIBE"
 
 
 class ServerAction(GetValueEnum):
     PLAYER_STATE = "PLAYER_STATE"
     GAME_STATE = "GAME_STATE"
     TIMER = "TIMER"
+    GAME_HISTORY = "GAME_HISTORY"
+    MATCH_FOUND = "MATCH_FOUND"
+    ERROR = "ERROR"
+    RECONNECT = "RECONNECT"
+
+
+class InvalidAction(Exception):
+    pass
+
+
+def parse_user_id(data: dict):
+    user_id = data.get("id")
+    if not isinstance(user_id, str) or not 0 < len(user_id) <= MAX_USER_ID_LENGTH:
+        raise InvalidAction("Invalid id")
+    return user_id
+
+
+def parse_game_id(data: dict) -> UUID:
+    try:
+        return UUID(data.get("id"))
+    except (AttributeError, TypeError, ValueError):
+        raise InvalidAction("Invalid game id")
+
+
+def parse_path(data: dict):
+    path = data.get("game")
+    if (
+        not isinstance(path, str)
+        or not path.startswith("/")
+        or len(path) > MAX_PATH_LENGTH
+    ):
+        raise InvalidAction("Invalid game")
+    return path
+
+
+def parse_int(data: dict, key: str, default: int, minimum: int, maximum: int):
+    try:
+        value = int(data.get(key, default))
+    except (OverflowError, TypeError, ValueError):
+        raise InvalidAction(f"Invalid {key}")
+
+    if not minimum <= value <= maximum:
+        raise InvalidAction(f"Invalid {key}")
+    return value
 
 
 class ActionReceiver:
-    def __init__(self, websocket, game):
+    def __init__(self, websocket, game, rate_limiter: TokenBucket = None):
         self.websocket = websocket
         self.game = game
+        self.rate_limiter = rate_limiter or TokenBucket(
+            RATE_LIMIT_RATE, RATE_LIMIT_BURST
+        )
+        self.throttled = False
 
     async def listen(self):
         async for message in self.websocket:
-            logger.info(f"receive {self.game} {self.websocket} {message}")
-            parsed_message = json.loads(message)
+            parsed_message = self.parse(message)
+            if parsed_message is not None:
+                self.dispatch(parsed_message)
+
+    def parse(self, message):
+        # Cheap checks first, so floods never reach json parsing or the game
+        if not self.rate_limiter.consume():
+            if not self.throttled:
+                logger.warning(f"rate limiting {self.websocket}")
+                self.send_error("Rate limit exceeded")
+            self.throttled = True
+            return None
+        self.throttled = False
+
+        if len(message) > MAX_MESSAGE_SIZE:
+            self.send_error("Message too large")
+            return None
+
+        logger.info(f"receive {self.game} {self.websocket} {message}")
+
+        try:
+            return json.loads(message)
+        except (RecursionError, ValueError):
+            self.send_error("Invalid message")
+            return None
+
+    def dispatch(self, parsed_message):
+        try:
             self.receive(parsed_message)
+        except (InvalidAction, InvalidMove) as e:
+            logger.info(f"rejected message from {self.websocket}: {e}")
+            self.send_error(str(e))
+
+    def send_error(self, message: str):
+        self.game.send_error(self.websocket, message)
 
     def receive(self, action_tuple):
-        if len(action_tuple) != 2:
-            logger.error("Invalid message, skipping")
-            return
+        if not isinstance(action_tuple, list) or len(action_tuple) != 2:
+            raise InvalidAction("Invalid message")
 
         action = ClientAction.get_value(action_tuple[0])
         data = action_tuple[1]
 
+        if not action:
+            raise InvalidAction("Unknown action")
+
+        if not isinstance(data, dict):
+            raise InvalidAction("Invalid data")
+
         if action == ClientAction.IDENTIFY:
-            user_id = data.get("id")
-            self.game.identify(self.websocket, user_id)
+            user_id = parse_user_id(data)
+            last_seq = None
+            if data.get("last_seq") is not None:
+                last_seq = parse_int(data, "last_seq", 0, 0, sys.maxsize)
+            self.game.identify(self.websocket, user_id, last_seq)
 
         if action == ClientAction.SETTING:
-            total_length = int(data.get("total_length", 5))
-            per_move = int(data.get("per_move", 3))
-            self.game.set_mode(total_length, per_move)
+            if self.game.refuse_while_draining(self.websocket):
+                return
+
+            if "total_length" in data or "per_move" in data:
+                total_length = parse_int(
+                    data, "total_length", self.game.total_length, 1, MAX_TOTAL_LENGTH
+                )
+                per_move = parse_int(
+                    data, "per_move", self.game.per_move, 0, MAX_PER_MOVE
+                )
+                self.game.set_mode(total_length, per_move)
+
+            if "legal_moves" in data:
+                self.game.set_legal_move_hints(bool(data["legal_moves"]))
 
         if action == ClientAction.CONNECT:
-            user_id = data.get("id")
+            user_id = parse_user_id(data)
             self.game.connect(self.websocket, user_id)
 
         if action == ClientAction.MOVE:
             move = PieceMove.from_dict(data, self.game)
             self.game.move(self.websocket, move)
+
+        if action == ClientAction.PREMOVE:
+            if data:
+                PieceMove.from_dict(data, self.game)
+            self.game.premove(self.websocket, data)
+
+        if action == ClientAction.HISTORY:
+            self.game.send_history(self.websocket, parse_game_id(data))
+
+
+class MultiplexReceiver(ActionReceiver):
+    # Serves many games over one connection, messages are [action, data, game]
+    # where game is the path the game would otherwise be connected on.
+    receivers: Dict[str, ActionReceiver]
+
+    def __init__(self, websocket, get_game):
+        super().__init__(websocket, None)
+        self.get_game = get_game
+        self.receivers = {}
+
+    @property
+    def games(self):
+        return [receiver.game for receiver in self.receivers.values()]
+
+    def send_error(self, message: str):
+        asyncio.ensure_future(
+            self.send(get_message(ServerAction.ERROR, {"message": message}))
+        )
+
+    async def send(self, message: str):
+        try:
+            await self.websocket.send(message)
+        except websockets.ConnectionClosed:
+            pass
+
+    def receive(self, action_tuple):
+        if not isinstance(action_tuple, list) or len(action_tuple) != 3:
+            raise InvalidAction("Invalid message")
+
+        action = ClientAction.get_value(action_tuple[0])
+        path = parse_path({"game": action_tuple[2]})
+
+        if action == ClientAction.SUBSCRIBE:
+            self.subscribe(path)
+        elif action == ClientAction.UNSUBSCRIBE:
+            self.unsubscribe(path)
+        elif path in self.receivers:
+            self.receivers[path].dispatch(action_tuple[:2])
+        else:
+            raise InvalidAction("Not subscribed")
+
+    def subscribe(self, path: str):
+        if path in self.receivers:
+            return
+
+        if len(self.receivers) >= MAX_SUBSCRIPTIONS:
+            raise InvalidAction("Too many subscriptions")
+
+        game = self.get_game(path)
+        if not game:
+            raise InvalidAction("Server is restarting")
+
+        self.receivers[path] = ActionReceiver(self.websocket, game, self.rate_limiter)
+        game.subscribe(self.websocket)
+
+    def unsubscribe(self, path: str):
+        receiver = self.receivers.pop(path, None)
+        if receiver:
+            receiver.game.unsubscribe(self.websocket)
+
+    def unsubscribe_all(self):
+        for path in list(self.receivers):
+            self.unsubscribe(path)
@@ -0,0 +1,249 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from asyncio import events
+from collections import Counter, deque
+from typing import Deque, Tuple
+
+import game
+
+logger = logging.getLogger(__name__)
+
+ADMIN_HOST = "127.0.0.1"
+ADMIN_PORT = os.environ.get("ADMIN_PORT")
+SAMPLE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 60
+SLOW_CALLBACKS_SIZE = 100
+GAMES_SAMPLE_SIZE = int(os.environ.get("ADMIN_GAMES_SAMPLE_SIZE", 100))
+
+HELP = """commands:
+  games [sample]         stats and estimated memory for a sample of games
+  profile [seconds]      sample the event loop thread and report hot functions
+  slow [ms|off]          record callbacks slower than ms, list recorded ones
+  memory [count|off]     tracemalloc top allocators
+  help"""
+
+
+class StackSampler:
+    def __init__(self, thread_id: int, interval: float = SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.own = Counter()
+        self.cumulative = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            self.samples += 1
+            self.own[self.describe(frame)] += 1
+
+            seen = set()
+            while frame is not None:
+                key = self.describe(frame)
+                if key not in seen:
+                    self.cumulative[key] += 1
+                    seen.add(key)
+                frame = frame.f_back
+
+    @staticmethod
+    def describe(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_filename}:{code.co_firstlineno}({code.co_name})"
+
+    def report(self, limit: int = 20) -> str:
+        if not self.samples:
+            return "no samples"
+
+        lines = [f"{self.samples} samples", "own:"]
+        for key, count in self.own.most_common(limit):
+            lines.append(f"  {count / self.samples:6.1%} {key}")
+        lines.append("cumulative:")
+        for key, count in self.cumulative.most_common(limit):
+            lines.append(f"  {count / self.samples:6.1%} {key}")
+        return "\n".join(lines)
+
+
+class SlowCallbackTracker:
+    # Wraps asyncio Handle._run, the same hook asyncio debug mode uses for its
+    # slow callback warnings, without turning on the rest of debug mode.
+    slow_callbacks: Deque[Tuple[float, float, str]]
+
+    def __init__(self):
+        self.threshold = None
+        self.original_run = events.Handle._run
+        self.slow_callbacks = deque(maxlen=SLOW_CALLBACKS_SIZE)
+
+    def enable(self, threshold: float):
+        self.threshold = threshold
+        if events.Handle._run is not self.original_run:
+            return
+
+        tracker = self
+        original_run = self.original_run
+
+        def _run(handle):
+            started_at = time.perf_counter()
+            original_run(handle)
+            duration = time.perf_counter() - started_at
+            if tracker.threshold is not None and duration >= tracker.threshold:
+                tracker.slow_callbacks.append((time.time(), duration, repr(handle)))
+
+        events.Handle._run = _run
+
+    def disable(self):
+        self.threshold = None
+        events.Handle._run = self.original_run
+
+    def report(self) -> str:
+        if self.threshold is None:
+            state = "disabled"
+        else:
+            state = f"threshold {self.threshold * 1000:.1f}ms"
+
+        lines = [f"slow callbacks ({state}):"]
+        for at, duration, callback in self.slow_callbacks:
+            moment = time.strftime("%H:%M:%S", time.localtime(at))
+            lines.append(f"  {moment} {duration * 1000:8.1f}ms {callback}")
+        return "\n".join(lines)
+
+
+slow_callback_tracker = SlowCallbackTracker()
+profile_lock = asyncio.Lock()
+
+
+def get_game_stats(path: str, chess_game: "game.ChessGame") -> dict:
+    # Serializing and walking a game costs about half a millisecond, this runs
+    # on the event loop so it is only done for a bounded sample of games
+    return {
+        "path": path,
+        "id": str(chess_game.id),
+        "state": chess_game.state.value,
+        "moves": len(chess_game.moves),
+        "message_queue": len(chess_game.message_queue),
+        "replay_buffer": len(chess_game.replay_buffer),
+        "state_size": len(json.dumps(chess_game.to_serializable_dict())),
+        "memory": chess_game.estimate_memory(),
+        "timings": {
+            name: round(value, 6) for name, value in chess_game.timings.items()
+        },
+    }
+
+
+def games_command(sample=GAMES_SAMPLE_SIZE, *args) -> str:
+    games = list(game.paths.items())
+    sampled = random.sample(games, min(int(sample), len(games)))
+    stats = [get_game_stats(path, x) for path, x in sampled]
+    memory = sum(x["memory"] for x in stats)
+    summary = (
+        f"{len(games)} games, {threading.active_count()} threads, "
+        f"~{memory // max(len(stats), 1)} bytes per game "
+        f"({len(stats)} sampled)"
+    )
+    return "\n".join([summary] + [json.dumps(x) for x in stats])
+
+
+async def profile_command(seconds="5", *args) -> str:
+    seconds = min(float(seconds), MAX_PROFILE_SECONDS)
+
+    if profile_lock.locked():
+        return "profiler is already running"
+
+    async with profile_lock:
+        sampler = StackSampler(threading.get_ident())
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            sampler.stop()
+
+    return sampler.report()
+
+
+def slow_command(threshold=None, *args) -> str:
+    if threshold == "off":
+        slow_callback_tracker.disable()
+    elif threshold is not None:
+        slow_callback_tracker.enable(float(threshold) / 1000)
+
+    return slow_callback_tracker.report()
+
+
+def memory_command(limit="10", *args) -> str:
+    if limit == "off":
+        tracemalloc.stop()
+        return "tracemalloc stopped"
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        return "tracemalloc started, run again to see top allocators"
+
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"traced {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB"]
+    for stat in snapshot.statistics("lineno")[: int(limit)]:
+        lines.append(f"  {stat}")
+    return "\n".join(lines)
+
+
+COMMANDS = {
+    "games": games_command,
+    "profile": profile_command,
+    "slow": slow_command,
+    "memory": memory_command,
+    "help": lambda *args: HELP,
+}
+
+
+async def execute(line: str) -> str:
+    command, *args = line.split() or ["help"]
+    handler = COMMANDS.get(command)
+    if not handler:
+        return f"unknown command {command}\n{HELP}"
+
+    try:
+        result = handler(*args)
+        if asyncio.iscoroutine(result):
+            result = await result
+    except (TypeError, ValueError) as e:
+        return f"error: {e}"
+
+    return result
+
+
+async def admin_handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    logger.info(f"admin connected {writer.get_extra_info('peername')}")
+
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+
+        response = await execute(line.decode("utf-8", "ignore").strip())
+        writer.write(f"{response}\n".encode("utf-8"))
+        await writer.drain()
+
+    writer.close()
+
+
+def start_admin_server(port=ADMIN_PORT):
+    logger.info(f"Starting admin interface on {ADMIN_HOST}:{port}")
+    return asyncio.start_server(admin_handler, ADMIN_HOST, int(port))
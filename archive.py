@@ -0,0 +1,206 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+from typing import TYPE_CHECKING, Dict, List, Union
+from uuid import UUID
+
+from player import PlayerColor
+
+if TYPE_CHECKING:
+    from game import ChessGame
+    from piece_move import PieceMove
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_PATH = os.environ.get("GAME_ARCHIVE_PATH", "games.archive")
+
+# game id, started_at, total_length, per_move, winner, white/black remaining time,
+# white/black user id, move count
+HEADER = struct.Struct("<16sdIIBff64s64sH")
+# game id, offset of the header in the data file
+INDEX_ENTRY = struct.Struct("<16sQ")
+
+MOVE_TAKES = 0b0001
+MOVE_NESTED = 0b0010
+
+WINNER_CODES = {None: 0, PlayerColor.WHITE: 1, PlayerColor.BLACK: 2}
+WINNER_COLORS = {code: color for color, code in WINNER_CODES.items()}
+
+
+def encode_square(x: int, y: int) -> int:
+    if not (1 <= x <= 8 and 1 <= y <= 8):
+        raise ValueError(f"square [{x},{y}] is off the board")
+    return (x - 1) + (y - 1) * 8
+
+
+def decode_square(square: int):
+    return square % 8 + 1, square // 8 + 1
+
+
+def encode_move(from_x: int, from_y: int, move: "PieceMove") -> int:
+    flags = 0
+    if move.takes:
+        flags |= MOVE_TAKES
+    if move.nested:
+        flags |= MOVE_NESTED
+
+    return (
+        encode_square(from_x, from_y) << 10 | encode_square(move.x, move.y) << 4 | flags
+    )
+
+
+def decode_move(value: int) -> dict:
+    from_x, from_y = decode_square(value >> 10)
+    x, y = decode_square((value >> 4) & 0b111111)
+
+    return {
+        "from": {"x": from_x, "y": from_y},
+        "to": {"x": x, "y": y},
+        "takes": bool(value & MOVE_TAKES),
+        "nested": bool(value & MOVE_NESTED),
+    }
+
+
+# Finished games are appended to `path` as a fixed header followed by 16-bit moves,
+# `path.idx` holds fixed size (game id, offset) records. The data file is read
+# through a memory map so serving a game never loads the whole archive, the index
+# is kept as an id -> offset dict that only reads records appended since the last
+# lookup.
+class GameArchive:
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = f"{path}.idx"
+        self.lock = threading.Lock()
+        self._maps: Dict[str, mmap.mmap] = {}
+        self._offsets: Dict[bytes, int] = {}
+        self._indexed_size = 0
+
+    def append(self, game: "ChessGame"):
+        white = game.get_player_by_color(PlayerColor.WHITE)
+        black = game.get_player_by_color(PlayerColor.BLACK)
+        moves = game.moves
+
+        header = HEADER.pack(
+            game.id.bytes,
+            game.started_at,
+            game.total_length,
+            game.per_move,
+            WINNER_CODES[game.winner],
+            white.remaining_time if white else 0,
+            black.remaining_time if black else 0,
+            self._pack_user_id(white),
+            self._pack_user_id(black),
+            len(moves),
+        )
+
+        with self.lock:
+            with open(self.path, "ab") as f:
+                offset = f.tell()
+                f.write(header)
+                f.write(struct.pack(f"<{len(moves)}H", *moves))
+
+            with open(self.index_path, "ab") as f:
+                f.write(INDEX_ENTRY.pack(game.id.bytes, offset))
+
+        logger.info(f"archived game {game.id} at {offset} with {len(moves)} moves")
+
+    def read(self, game_id: Union[UUID, str]) -> Union[dict, None]:
+        if not isinstance(game_id, UUID):
+            try:
+                game_id = UUID(game_id)
+            except (TypeError, ValueError):
+                return None
+
+        with self.lock:
+            offset = self._find_offset(game_id)
+            if offset is None:
+                return None
+
+            data = self._map(self.path)
+            return self._decode(data, offset)
+
+    def _find_offset(self, game_id: UUID) -> Union[int, None]:
+        self._load_index()
+        return self._offsets.get(game_id.bytes)
+
+    def _load_index(self):
+        index = self._map(self.index_path)
+        if index is None:
+            return
+
+        end = len(index) - len(index) % INDEX_ENTRY.size
+        if end <= self._indexed_size:
+            return
+
+        for raw_id, offset in INDEX_ENTRY.iter_unpack(index[self._indexed_size : end]):
+            self._offsets[raw_id] = offset
+        self._indexed_size = end
+
+    def _map(self, path: str) -> Union[mmap.mmap, None]:
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return None
+
+        mapped = self._maps.get(path)
+        if mapped is None or len(mapped) != os.path.getsize(path):
+            if mapped is not None:
+                mapped.close()
+            with open(path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[path] = mapped
+
+        return mapped
+
+    @staticmethod
+    def _decode(data: mmap.mmap, offset: int) -> dict:
+        (
+            raw_id,
+            started_at,
+            total_length,
+            per_move,
+            winner,
+            white_time,
+            black_time,
+            white_id,
+            black_id,
+            move_count,
+        ) = HEADER.unpack_from(data, offset)
+
+        moves_offset = offset + HEADER.size
+        moves: List[int] = struct.unpack_from(f"<{move_count}H", data, moves_offset)
+        winner = WINNER_COLORS[winner]
+
+        return {
+            "id": str(UUID(bytes=raw_id)),
+            "started_at": started_at,
+            "total_length": total_length,
+            "per_move": per_move,
+            "winner": winner.value if winner else None,
+            "players": [
+                {
+                    "id": GameArchive._unpack_user_id(white_id),
+                    "color": PlayerColor.WHITE.value,
+                    "remaining_time": white_time,
+                },
+                {
+                    "id": GameArchive._unpack_user_id(black_id),
+                    "color": PlayerColor.BLACK.value,
+                    "remaining_time": black_time,
+                },
+            ],
+            "moves": [decode_move(move) for move in moves],
+        }
+
+    @staticmethod
+    def _pack_user_id(player) -> bytes:
+        if not player or player.user_id is None:
+            return b""
+        return str(player.user_id).encode("utf-8")[:64]
+
+    @staticmethod
+    def _unpack_user_id(raw: bytes) -> Union[str, None]:
+        return raw.rstrip(b"\x00").decode("utf-8", "ignore") or None
+
+
+archive = GameArchive(ARCHIVE_PATH)
@@ -0,0 +1,173 @@
+import argparse
+import gc
+import resource
+import threading
+import time
+import tracemalloc
+from typing import Callable, List
+
+from game import ChessGame, GameState
+from piece_move import PieceMove
+from player import PlayerColor
+
+OPENING = [
+    ((5, 2), (5, 4)),
+    ((5, 7), (5, 5)),
+    ((7, 1), (6, 3)),
+    ((2, 8), (3, 6)),
+    ((6, 1), (3, 4)),
+    ((7, 8), (6, 6)),
+]
+
+
+class FakeSocket:
+    pass
+
+
+def create_waiting_game(ticks: int) -> ChessGame:
+    game = ChessGame()
+    game.connect(FakeSocket(), "user-1")
+    return game
+
+
+def create_playing_game(ticks: int) -> ChessGame:
+    game = create_waiting_game(ticks)
+    game.connect(FakeSocket(), "user-2")
+
+    for (from_x, from_y), (x, y) in OPENING:
+        game.perform_move(PieceMove(game.find_piece_at(from_x, from_y), x, y))
+        game.send_state()
+
+    # Timer broadcasts of `ticks` seconds of play that the producer already sent
+    for _ in range(ticks):
+        game.send_game_time()
+    game.message_queue = []
+
+    return game
+
+
+def create_ended_game(ticks: int) -> ChessGame:
+    game = create_playing_game(ticks)
+    game.state = GameState.ENDED
+    game.winner = PlayerColor.WHITE
+    return game
+
+
+STATES = {
+    "waiting": create_waiting_game,
+    "playing": create_playing_game,
+    "ended": create_ended_game,
+}
+
+
+class GcPauses:
+    def __init__(self):
+        self.pauses: List[float] = []
+        self.started_at = 0.0
+
+    def __call__(self, phase, info):
+        if phase == "start":
+            self.started_at = time.perf_counter()
+        else:
+            self.pauses.append(time.perf_counter() - self.started_at)
+
+    def report(self) -> str:
+        if not self.pauses:
+            return "no collections"
+        return (
+            f"{len(self.pauses)} collections, "
+            f"total {sum(self.pauses) * 1000:.1f}ms, "
+            f"max {max(self.pauses) * 1000:.2f}ms"
+        )
+
+
+def get_rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return 0
+
+
+def measure(
+    create: Callable[[int], ChessGame], count: int, ticks: int, traced_sample: int
+):
+    gc.collect()
+    pauses = GcPauses()
+    gc.callbacks.append(pauses)
+    rss_before = get_rss()
+    started_at = time.perf_counter()
+
+    # tracemalloc slows allocation down a lot, so only a sample is traced
+    traced_count = min(count, traced_sample)
+    tracemalloc.start()
+    traced_before, _ = tracemalloc.get_traced_memory()
+    games = [create(ticks) for _ in range(traced_count)]
+    traced_after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    games += [create(ticks) for _ in range(count - traced_count)]
+    elapsed = time.perf_counter() - started_at
+    rss_after = get_rss()
+
+    full_collection_at = time.perf_counter()
+    gc.collect()
+    full_collection = time.perf_counter() - full_collection_at
+    gc.callbacks.remove(pauses)
+
+    traced = (traced_after - traced_before) / max(traced_count, 1)
+    estimated = sum(game.estimate_memory() for game in games[:100]) / min(count, 100)
+
+    print(f"  created in {elapsed:.2f}s")
+    print(f"  traced {traced:.0f} bytes per game ({traced_count} sampled)")
+    print(f"  estimated {estimated:.0f} bytes per game (ChessGame.estimate_memory)")
+    if rss_before and rss_after:
+        print(f"  rss grew {(rss_after - rss_before) / count:.0f} bytes per game")
+    print(f"  gc while creating: {pauses.report()}")
+    print(f"  full gc with {count} games alive: {full_collection * 1000:.1f}ms")
+
+    return games
+
+
+def measure_timer_threads(sample: int):
+    games = [create_playing_game(0) for _ in range(sample)]
+    threads_before = threading.active_count()
+
+    for game in games:
+        game.start_timer()
+    threads = threading.active_count() - threads_before
+
+    for game in games:
+        game.stop_timer()
+
+    print(f"  {threads / sample:.2f} threads per running game ({sample} sampled)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure memory used by games")
+    parser.add_argument("--games", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--states", nargs="+", choices=STATES, default=list(STATES))
+    parser.add_argument(
+        "--ticks", type=int, default=60, help="timer broadcasts per playing game"
+    )
+    parser.add_argument(
+        "--traced-sample", type=int, default=1000, help="games traced by tracemalloc"
+    )
+    parser.add_argument(
+        "--timer-sample", type=int, default=50, help="games to start timers for"
+    )
+    args = parser.parse_args()
+
+    for count in args.games:
+        for state in args.states:
+            print(f"{count} {state} games:")
+            games = measure(STATES[state], count, args.ticks, args.traced_sample)
+            del games
+
+    if args.timer_sample:
+        print("timers:")
+        measure_timer_threads(args.timer_sample)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,43 @@
+import enum
 import logging
+import os
 import random
+import struct
+import sys
+import threading
 import time
-from typing import Dict, List, Union
+from collections import deque
+from typing import Deque, Dict, List, Set, Tuple, Union
 from uuid import UUID, uuid4
 
 from websockets import WebSocketServerProtocol
 
 from actions import ServerAction
+from archive import archive, encode_move, encode_square
 from game_timer import GameTimer
 from piece import Bishop, King, Knight, Pawn, Queen
 from piece.base_piece import BasePiece
 from piece.rook import Rook
-from piece_move import PieceMove
-from player import Player, PlayerColor
-from utils import GetValueEnum, get_message
+from piece_move import InvalidMove, PieceMove
+from player import Player, PlayerColor, PlayerState
+from utils import GetValueEnum, get_message, timed
 
 logger = logging.getLogger(__name__)
 
+MAX_LAG_COMPENSATION = float(os.environ.get("MAX_LAG_COMPENSATION", 0.5))
+REPLAY_BUFFER_SIZE = int(os.environ.get("REPLAY_BUFFER_SIZE", 256))
+SEND_LEGAL_MOVES = os.environ.get("SEND_LEGAL_MOVES", "") == "1"
+
+PIECE_CLASSES = {
+    piece.type: piece for piece in (Pawn, Rook, Knight, Bishop, Queen, King)
+}
+
+draining = False
+
+
+class ServerDraining(Exception):
+    pass
+
 
 def get_inverse_color(color: PlayerColor):
     return PlayerColor.WHITE if color == PlayerColor.BLACK else PlayerColor.BLACK
@@ -32,24 +53,37 @@ class ChessGame:
     TIMER_PERIOD = 1
 
     id: UUID
+    path: Union[str, None] = None
     state: GameState
     timer: "GameTimer" = None
     started_at: float = 0
+    last_tick_at: float = 0
+    turn_started_at: float = 0
+    turn_charged: float = 0
     total_length: int = 60 * 5
     per_move: int = 3
+    max_lag_compensation: float = MAX_LAG_COMPENSATION
     winner: Union[PlayerColor, None] = None
 
     players: Dict[str, Player]
+    subscribers: Set[WebSocketServerProtocol]
 
     board: List[BasePiece]
     on_move: PlayerColor or None = None
+    legal_moves: Union[Dict[str, List[PieceMove]], None] = None
+    send_legal_moves: bool = SEND_LEGAL_MOVES
 
     message_queue: List
+    moves: List[int]
+    seq: int = 0
+    timings: Dict[str, float]
+    replay_buffer: Deque[Tuple[int, ServerAction, str]]
 
     def __init__(self):
         self.id = uuid4()
         self.state = GameState.WAITING
         self.players = {}
+        self.subscribers = set()
         self.connect_player_colors = [PlayerColor.WHITE, PlayerColor.BLACK]
         random.shuffle(self.connect_player_colors)
         self.board = [
@@ -87,21 +121,39 @@ class ChessGame:
             Rook(self, PlayerColor.WHITE, x=8, y=1),
         ]
         self.message_queue = []
+        self.moves = []
+        self.replay_buffer = deque(maxlen=REPLAY_BUFFER_SIZE)
+        self.replay_lock = threading.Lock()
+        self.timings = {}
 
     def set_mode(self, total_length: int, per_move: int):
         self.total_length = total_length
         self.per_move = per_move
 
-    def identify(self, websocket: WebSocketServerProtocol, user_id: str):
+    def identify(
+        self,
+        websocket: WebSocketServerProtocol,
+        user_id: str,
+        last_seq: Union[int, None] = None,
+    ):
+        if self.refuse_while_draining(websocket):
+            return
+
         player = self.players.get(user_id)
 
         if player:
             player.identify(websocket)
-            self.send_state()
+            if last_seq is not None and self.replay(websocket, last_seq):
+                self.send_game_time()
+            else:
+                self.send_state()
         elif self.can_player_join():
             self.connect(websocket, user_id)
 
     def connect(self, websocket: WebSocketServerProtocol, user_id: str):
+        if self.refuse_while_draining(websocket):
+            return
+
         if len(self.connect_player_colors) > 0:
             color = self.connect_player_colors.pop()
             logger.info(f"connect player {websocket} {color}")
@@ -126,6 +178,20 @@ class ChessGame:
 
         self.send_state()
 
+    def subscribe(self, websocket: WebSocketServerProtocol):
+        self.subscribers.add(websocket)
+        self.send_state(websocket)
+
+    def unsubscribe(self, websocket: WebSocketServerProtocol):
+        self.subscribers.discard(websocket)
+
+        if self.get_player_by_socket(websocket):
+            self.disconnect(websocket)
+
+    def get_recipients(self) -> List[WebSocketServerProtocol]:
+        sockets = [player.socket for player in self.players.values() if player.socket]
+        return sockets + [x for x in self.subscribers if x not in sockets]
+
     def can_player_join(self):
         return len(self.connect_player_colors) > 0
 
@@ -137,57 +203,286 @@ class ChessGame:
     def start_game(self):
         self.on_move = PlayerColor.WHITE
         self.state = GameState.PLAYING
+        self.start_turn()
 
         for player in self.players.values():
             player.set_playing()
 
+    def refuse_while_draining(self, websocket: WebSocketServerProtocol) -> bool:
+        # The snapshot handed to the replacement process is already taken
+        if draining:
+            self.send_error(websocket, "Server is restarting")
+        return draining
+
     def move(self, websocket: WebSocketServerProtocol, move: PieceMove):
+        if self.refuse_while_draining(websocket):
+            return
+
+        player = self.get_player_by_socket(websocket)
+        if not player:
+            return
+
+        if player.premove:
+            player.premove = None
+            player.send_state()
+
+        self.play_move(player, move)
+        self.send_state()
+
+    def play_move(self, player: Player, move: PieceMove):
+        # The first move starts the clock and earns no increment
         should_add_time = True
         if not self.timer:
             should_add_time = False
             self.start_timer()
 
-        if websocket not in [x.socket for x in self.players.values()]:
+        lag_compensation = self.get_lag_compensation(player)
+        if self.perform_move(move, should_add_time, lag_compensation):
+            self.perform_premove()
+
+    def perform_move(
+        self,
+        move: PieceMove,
+        should_add_time: bool = True,
+        lag_compensation: float = 0.0,
+    ) -> bool:
+        try:
+            encoded_move = encode_move(move.piece.x, move.piece.y, move)
+        except ValueError:
+            return False
+
+        if not move.perform(self):
+            return False
+
+        self.moves.append(encoded_move)
+        self.legal_moves = None
+        if should_add_time:
+            player = self.get_player_by_color(self.on_move)
+            player.remaining_time += self.per_move + lag_compensation
+        self.switch_on_move()
+
+        return True
+
+    def get_legal_moves(self) -> Dict[str, List[PieceMove]]:
+        for piece in self.board:
+            if piece.color == self.on_move:
+                self.get_possible_moves(piece)
+        return self.legal_moves or {}
+
+    def get_possible_moves(self, piece: BasePiece) -> List[PieceMove]:
+        # Moves of the side to move are generated once per position and per
+        # piece, shared by move validation and the hints
+        if not self.on_move or piece.color != self.on_move:
+            return self.generate_moves(piece)
+
+        if self.legal_moves is None:
+            self.legal_moves = {}
+        if piece.id not in self.legal_moves:
+            self.legal_moves[piece.id] = self.generate_moves(piece)
+        return self.legal_moves[piece.id]
+
+    def generate_moves(self, piece: BasePiece) -> List[PieceMove]:
+        with timed(self.timings, "get_possible_moves"):
+            return [
+                move
+                for move in piece.get_possible_moves()
+                if 1 <= move.x <= 8 and 1 <= move.y <= 8
+            ]
+
+    def set_legal_move_hints(self, enabled: bool):
+        self.send_legal_moves = enabled
+
+    def get_lag_compensation(self, player: Player) -> float:
+        # The mover was charged for the state reaching them and for their move
+        # reaching us, roughly one round trip, but never more than this turn
+        # actually took from their clock
+        if player.rtt is None:
+            return 0.0
+        elapsed = time.monotonic() - self.turn_started_at
+        return min(player.rtt, self.max_lag_compensation, elapsed, self.turn_charged)
+
+    def record_rtt(self, websocket: WebSocketServerProtocol, rtt: float):
+        player = self.get_player_by_socket(websocket)
+        if player:
+            player.record_rtt(rtt)
+
+    def premove(self, websocket: WebSocketServerProtocol, data: Union[dict, None]):
+        if self.refuse_while_draining(websocket):
             return
 
-        if move.perform(self):
-            if should_add_time:
-                player = self.get_player_by_color(self.on_move)
-                player.remaining_time += self.per_move
-            self.switch_on_move()
+        player = self.get_player_by_socket(websocket)
+        if not player:
+            return
 
-        self.send_state()
+        player.premove = data or None
+
+        # The opponent's move arrived before our state reached the client, the
+        # premove is already playable and is played like a normal move
+        if (
+            player.premove
+            and player.color == self.on_move
+            and self.state == GameState.PLAYING
+        ):
+            move = self.take_premove(player)
+            if move:
+                self.play_move(player, move)
+            player.send_state()
+            self.send_state()
+        else:
+            player.send_state()
+
+    def perform_premove(self):
+        # Executed in the same event loop turn as the opponent's move, so the
+        # timer never gets the chance to charge the premoving player.
+        player = self.get_player_by_color(self.on_move)
+        if not player or not player.premove or self.state != GameState.PLAYING:
+            return
+
+        move = self.take_premove(player)
+        if move and not self.perform_move(move):
+            logger.info(f"premove {move} is not possible, discarding")
+
+        player.send_state()
+
+    def take_premove(self, player: Player) -> Union[PieceMove, None]:
+        data, player.premove = player.premove, None
+
+        try:
+            move = PieceMove.from_dict(data, self)
+        except InvalidMove:
+            logger.info(f"discarding invalid premove {data}")
+            return None
+
+        if move.piece.color != player.color:
+            return None
+        return move
 
     def start_timer(self):
         self.started_at = time.time()
+        self.last_tick_at = time.monotonic()
         self.timer = GameTimer(self, self.TIMER_PERIOD)
 
+    def stop_timer(self):
+        if not self.timer or not self.timer.running:
+            return
+
+        self.timer.stop()
+
+        # Charge the part of the current period that already elapsed, so the
+        # clock resumes exactly where it stopped
+        player_on_move = self.get_player_by_color(self.on_move)
+        if self.state == GameState.PLAYING and player_on_move:
+            player_on_move.remaining_time -= time.monotonic() - self.last_tick_at
+
     def timer_cycle(self):
+        self.last_tick_at = time.monotonic()
         player_on_move = self.get_player_by_color(self.on_move)
         player_on_move.remaining_time -= self.TIMER_PERIOD
+        self.turn_charged += self.TIMER_PERIOD
 
         if player_on_move.remaining_time <= 0:
-            self.state = GameState.ENDED
-            self.winner = get_inverse_color(self.on_move)
-            self.send_state()
+            self.end_game(get_inverse_color(self.on_move))
         else:
             self.send_game_time()
 
-    def send_game_time(self):
+    def end_game(self, winner: Union[PlayerColor, None]):
+        self.state = GameState.ENDED
+        self.winner = winner
+        self.send_state()
+
+        try:
+            archive.append(self)
+        except (OSError, struct.error):
+            logger.exception(f"failed to archive game {self.id}")
+
+    def send_history(self, websocket: WebSocketServerProtocol, game_id: UUID):
+        history = archive.read(game_id)
+        if history is None:
+            self.send_error(websocket, "Unknown game")
+            return
+
         self.message_queue.append(
-            (None, get_message(ServerAction.TIMER, self.to_serializable_dict_timer()))
+            (websocket, get_message(ServerAction.GAME_HISTORY, history))
         )
 
+    def send_error(self, websocket: WebSocketServerProtocol, message: str):
+        self.message_queue.append(
+            (websocket, get_message(ServerAction.ERROR, {"message": message}))
+        )
+
+    def send_reconnect(self):
+        self.message_queue.append(
+            (None, get_message(ServerAction.RECONNECT, {"seq": self.seq}))
+        )
+
+    def send_game_time(self):
+        self.broadcast(ServerAction.TIMER, self.to_serializable_dict_timer())
+
+    def broadcast(self, action: ServerAction, data: dict):
+        # Also called from the timer thread, seq and the replay buffer are
+        # shared with the event loop
+        with self.replay_lock:
+            self.seq += 1
+            message = get_message(action, {**data, "seq": self.seq})
+            self.replay_buffer.append((self.seq, action, message))
+            self.message_queue.append((None, message))
+
+    def can_replay(self, last_seq: int) -> bool:
+        if last_seq > self.seq:
+            return False
+        if last_seq == self.seq:
+            return True
+        return bool(self.replay_buffer) and self.replay_buffer[0][0] <= last_seq + 1
+
+    def replay(self, websocket: WebSocketServerProtocol, last_seq: int) -> bool:
+        with self.replay_lock:
+            if not self.can_replay(last_seq):
+                return False
+            replay_buffer = list(self.replay_buffer)
+
+        missed = []
+        for seq, action, message in replay_buffer:
+            if seq <= last_seq:
+                continue
+            # Game state is a full snapshot, anything before it is superseded
+            if action == ServerAction.GAME_STATE:
+                missed = []
+            missed.append(message)
+
+        for message in missed:
+            self.message_queue.append((websocket, message))
+
+        return True
+
     def switch_on_move(self):
         self.on_move = (
             PlayerColor.WHITE
             if self.on_move == PlayerColor.BLACK
             else PlayerColor.BLACK
         )
+        self.start_turn()
+
+    def start_turn(self):
+        self.turn_started_at = time.monotonic()
+        self.turn_charged = 0
 
     def send_state(self, send_to: WebSocketServerProtocol = None):
+        with timed(self.timings, "send_state"):
+            self._send_state(send_to)
+
+    def _send_state(self, send_to: WebSocketServerProtocol = None):
+        if not send_to:
+            self.broadcast(ServerAction.GAME_STATE, self.to_serializable_dict())
+            return
+
         self.message_queue.append(
-            (send_to, get_message(ServerAction.GAME_STATE, self.to_serializable_dict()))
+            (
+                send_to,
+                get_message(
+                    ServerAction.GAME_STATE,
+                    {**self.to_serializable_dict(), "seq": self.seq},
+                ),
+            )
         )
 
     def to_serializable_dict(self):
@@ -197,9 +492,85 @@ class ChessGame:
             "board": [x.to_serializable_dict() for x in self.board],
             "on_move": self.on_move.value if self.on_move else None,
             "winner": self.winner.value if self.winner else None,
+            **self.to_serializable_dict_legal_moves(),
             **self.to_serializable_dict_timer(),
         }
 
+    def to_serializable_dict_legal_moves(self):
+        if not self.send_legal_moves or self.state != GameState.PLAYING:
+            return {}
+
+        # Target squares of each origin square as a hex encoded 64-bit mask,
+        # bit n is square (n % 8 + 1, n // 8 + 1)
+        masks = {}
+        for moves in self.get_legal_moves().values():
+            for move in moves:
+                square = encode_square(move.piece.x, move.piece.y)
+                target = 1 << encode_square(move.x, move.y)
+                masks[square] = masks.get(square, 0) | target
+
+        return {
+            "legal_moves": {
+                str(square): format(mask, "x") for square, mask in masks.items()
+            }
+        }
+
+    def to_snapshot(self) -> dict:
+        return {
+            "id": str(self.id),
+            "path": self.path,
+            "state": self.state.value,
+            "started_at": self.started_at,
+            "total_length": self.total_length,
+            "per_move": self.per_move,
+            "winner": self.winner.value if self.winner else None,
+            "on_move": self.on_move.value if self.on_move else None,
+            "timer": self.timer is not None,
+            "send_legal_moves": self.send_legal_moves,
+            "connect_player_colors": [x.value for x in self.connect_player_colors],
+            "board": [x.to_serializable_dict() for x in self.board],
+            "players": [x.to_snapshot() for x in self.players.values()],
+            "moves": list(self.moves),
+            "seq": self.seq,
+            "replay_buffer": [
+                (seq, action.value, message)
+                for seq, action, message in list(self.replay_buffer)
+            ],
+        }
+
+    @staticmethod
+    def from_snapshot(data: dict) -> "ChessGame":
+        game = ChessGame()
+        game.id = UUID(data["id"])
+        game.path = data["path"]
+        game.state = GameState.get_value(data["state"])
+        game.started_at = data["started_at"]
+        game.total_length = data["total_length"]
+        game.per_move = data["per_move"]
+        game.winner = PlayerColor.get_value(data["winner"])
+        game.on_move = PlayerColor.get_value(data["on_move"])
+        game.connect_player_colors = [
+            PlayerColor.get_value(x) for x in data["connect_player_colors"]
+        ]
+        game.board = [restore_piece(game, x) for x in data["board"]]
+        game.players = {
+            x["user_id"]: Player.from_snapshot(game, x) for x in data["players"]
+        }
+        game.moves = data["moves"]
+        game.send_legal_moves = data["send_legal_moves"]
+        game.seq = data["seq"]
+        game.replay_buffer.extend(
+            (seq, ServerAction.get_value(action), message)
+            for seq, action, message in data["replay_buffer"]
+        )
+
+        if data["timer"]:
+            game.last_tick_at = time.monotonic()
+            game.start_turn()
+            game.timer = GameTimer(game, game.TIMER_PERIOD)
+
+        return game
+
     def to_serializable_dict_timer(self):
         return {
             "server_time": time.time(),
@@ -208,6 +579,39 @@ class ChessGame:
             ],
         }
 
+    def estimate_memory(self) -> int:
+        # Only objects owned by the game model are walked, sockets, the timer
+        # and shared enum members are not counted
+        seen = set()
+        stack = [self]
+        total = 0
+
+        while stack:
+            obj = stack.pop()
+            if id(obj) in seen or obj is None or isinstance(obj, (bool, enum.Enum)):
+                continue
+            seen.add(id(obj))
+
+            if isinstance(obj, (ChessGame, Player, BasePiece, PieceMove)):
+                total += sys.getsizeof(obj) + sys.getsizeof(obj.__dict__)
+                stack.extend(obj.__dict__.values())
+            elif isinstance(obj, dict):
+                total += sys.getsizeof(obj)
+                stack.extend(obj.keys())
+                stack.extend(obj.values())
+            elif isinstance(obj, (list, tuple, set, deque)):
+                total += sys.getsizeof(obj)
+                stack.extend(obj)
+            elif isinstance(obj, (str, bytes, int, float, UUID)):
+                total += sys.getsizeof(obj)
+
+        return total
+
+    def get_player_by_socket(self, websocket: WebSocketServerProtocol):
+        for player in self.players.values():
+            if player.socket and player.socket == websocket:
+                return player
+
     def get_player_by_color(self, color: PlayerColor):
         for player in self.players.values():
             if player.color == color:
@@ -227,13 +631,64 @@ class ChessGame:
 paths = {}
 
 
-def get_game(path, create_new=True) -> ChessGame:
+def restore_piece(game: ChessGame, data: dict) -> BasePiece:
+    piece_class = PIECE_CLASSES[BasePiece.Type.get_value(data["type"])]
+    color = PlayerColor.get_value(data["color"])
+    piece = piece_class(game, color, data["x"], data["y"])
+    piece.id = data["id"]
+    piece.move_count = data["move_count"]
+    return piece
+
+
+def get_game(path, create_new=True) -> Union[ChessGame, None]:
     logger.info(f"getting game for path {path}")
 
-    if create_new and path not in paths:
+    if create_new and path not in paths and not draining:
         game = ChessGame()
+        game.path = path
         paths[path] = game
 
-    logger.info(f"game {paths[path]}")
+    logger.info(f"game {paths.get(path)}")
+
+    return paths.get(path)
+
+
+def create_game() -> Tuple[str, ChessGame]:
+    if draining:
+        raise ServerDraining("Server is restarting")
+
+    game = ChessGame()
+    path = f"/{game.id}"
+    game.path = path
+    paths[path] = game
+
+    logger.info(f"created game {game} for path {path}")
+
+    return path, game
+
+
+def is_draining() -> bool:
+    return draining
+
+
+def start_draining() -> List[dict]:
+    global draining
+    draining = True
+
+    snapshots = []
+    for game in paths.values():
+        if game.state == GameState.ENDED:
+            continue
+
+        game.stop_timer()
+        snapshots.append(game.to_snapshot())
+
+    return snapshots
+
+
+def restore_games(snapshots: List[dict]):
+    for data in snapshots:
+        game = ChessGame.from_snapshot(data)
+        paths[game.path] = game
 
-    return paths[path]
+        logger.info(f"restored game {game.id} for path {game.path}")
@@ -8,11 +8,17 @@ class GameTimer:
     def __init__(self, game: "game.ChessGame", interval):
         self.game = game
         self.interval = interval
+        self.running = True
 
         thread = threading.Thread(target=self.run, args=())
         thread.start()
 
+    def stop(self):
+        self.running = False
+
     def run(self):
-        while self.game.state == game.GameState.PLAYING:
+        while self.running and self.game.state == game.GameState.PLAYING:
             time.sleep(self.interval)
+            if not self.running:
+                break
             self.game.timer_cycle()
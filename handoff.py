@@ -0,0 +1,95 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import struct
+import time
+import zlib
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+HANDOFF_PATH = os.environ.get("HANDOFF_PATH", "/tmp/online-chess-handoff.sock")
+HANDOFF_TIMEOUT = float(os.environ.get("HANDOFF_TIMEOUT", 20))
+# How long a starting process waits for the old one to serve its games, set it
+# to 0 when no old process is running
+HANDOFF_WAIT = float(os.environ.get("HANDOFF_WAIT", 10))
+
+LENGTH = struct.Struct("<I")
+
+
+def encode_snapshots(snapshots: List[dict]) -> bytes:
+    return zlib.compress(json.dumps(snapshots, separators=(",", ":")).encode("utf-8"))
+
+
+def decode_snapshots(payload: bytes) -> List[dict]:
+    return json.loads(zlib.decompress(payload).decode("utf-8"))
+
+
+def remove_socket_file(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+async def serve_snapshots(
+    snapshots: List[dict], path: str = HANDOFF_PATH, timeout: float = HANDOFF_TIMEOUT
+) -> bool:
+    payload = encode_snapshots(snapshots)
+    handed_off = asyncio.Event()
+
+    async def send(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write(LENGTH.pack(len(payload)) + payload)
+        await writer.drain()
+        writer.close()
+        handed_off.set()
+
+    remove_socket_file(path)
+    server = await asyncio.start_unix_server(send, path=path)
+    logger.info(f"serving {len(snapshots)} games ({len(payload)} bytes) on {path}")
+
+    try:
+        await asyncio.wait_for(handed_off.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        logger.warning(f"no replacement process connected within {timeout}s")
+        return False
+    finally:
+        server.close()
+        remove_socket_file(path)
+
+
+def read_exactly(connection: socket.socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("hand-off connection closed early")
+        data += chunk
+    return data
+
+
+def receive_snapshots(path: str = HANDOFF_PATH, wait: float = HANDOFF_WAIT):
+    deadline = time.monotonic() + wait
+    logger.info(f"waiting up to {wait}s for games from {path}")
+
+    while True:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(HANDOFF_TIMEOUT)
+            try:
+                connection.connect(path)
+                (size,) = LENGTH.unpack(read_exactly(connection, LENGTH.size))
+                snapshots = decode_snapshots(read_exactly(connection, size))
+                logger.info(f"received {len(snapshots)} games from {path}")
+                return snapshots
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() >= deadline:
+                    logger.info(f"no games were handed off on {path}")
+                    return []
+            except (OSError, ValueError, zlib.error):
+                logger.exception(f"failed to receive games from {path}")
+                return []
+
+        time.sleep(0.1)
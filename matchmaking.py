@@ -0,0 +1,155 @@
+import asyncio
+import itertools
+import logging
+import os
+from bisect import bisect_left, insort
+from typing import Dict, List, Tuple, Union
+
+from websockets import WebSocketServerProtocol
+
+from game import ServerDraining, create_game, is_draining
+
+logger = logging.getLogger(__name__)
+
+RATING_WINDOW = int(os.environ.get("MATCHMAKING_RATING_WINDOW", 200))
+
+TimeControl = Tuple[int, int]
+
+
+class AlreadyQueued(Exception):
+    pass
+
+
+class QueueEntry:
+    websocket: WebSocketServerProtocol
+    user_id: str
+    time_control: TimeControl
+    rating: int
+    seq: int
+    future: "asyncio.Future[Union[str, None]]"
+
+    def __init__(self, websocket, user_id, time_control, rating, seq, future):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.time_control = time_control
+        self.rating = rating
+        self.seq = seq
+        self.future = future
+
+    @property
+    def key(self):
+        return self.rating, self.seq
+
+
+class Matchmaker:
+    # Waiting players are bucketed by time control, each bucket is kept sorted
+    # by rating so the closest opponent is found by bisection instead of a scan.
+    # Inserting and removing still shifts the bucket list, a memmove that stays
+    # cheap for thousands of waiting players per bucket.
+    buckets: Dict[TimeControl, List[Tuple[int, int, QueueEntry]]]
+    queued: Dict[str, QueueEntry]
+
+    def __init__(self, rating_window: int = RATING_WINDOW):
+        self.rating_window = rating_window
+        self.buckets = {}
+        self.queued = {}
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+    def enqueue(
+        self,
+        websocket: WebSocketServerProtocol,
+        user_id: str,
+        total_length: int,
+        per_move: int,
+        rating: int,
+    ) -> QueueEntry:
+        if is_draining():
+            raise ServerDraining("Server is restarting")
+
+        if user_id in self.queued:
+            raise AlreadyQueued(f"{user_id} is already queued")
+
+        time_control = (total_length, per_move)
+        entry = QueueEntry(
+            websocket,
+            user_id,
+            time_control,
+            rating,
+            next(self.counter),
+            asyncio.get_event_loop().create_future(),
+        )
+
+        opponent = self.pop_opponent(entry)
+        if opponent:
+            self.start_game(opponent, entry)
+        else:
+            bucket = self.buckets.setdefault(time_control, [])
+            insort(bucket, (rating, entry.seq, entry))
+            self.queued[user_id] = entry
+            logger.info(f"queued {user_id} for {time_control} with rating {rating}")
+
+        return entry
+
+    def cancel(self, entry: QueueEntry):
+        bucket = self.buckets.get(entry.time_control)
+        if not bucket:
+            return
+
+        index = bisect_left(bucket, entry.key)
+        if index < len(bucket) and bucket[index][2] is entry:
+            del bucket[index]
+            self.queued.pop(entry.user_id, None)
+            logger.info(f"removed {entry.user_id} from queue")
+
+        if not bucket:
+            del self.buckets[entry.time_control]
+
+    def drain(self):
+        # Queued players get no game on this process, they re-queue elsewhere
+        entries = list(self.queued.values())
+        self.buckets = {}
+        self.queued = {}
+
+        for entry in entries:
+            if not entry.future.done():
+                entry.future.set_result(None)
+
+        logger.info(f"released {len(entries)} queued players")
+
+    def pop_opponent(self, entry: QueueEntry) -> Union[QueueEntry, None]:
+        bucket = self.buckets.get(entry.time_control)
+        if not bucket:
+            return None
+
+        index = bisect_left(bucket, entry.key)
+        candidates = [i for i in (index - 1, index) if 0 <= i < len(bucket)]
+        best = min(candidates, key=lambda i: abs(bucket[i][0] - entry.rating))
+
+        if abs(bucket[best][0] - entry.rating) > self.rating_window:
+            return None
+
+        opponent = bucket.pop(best)[2]
+        self.queued.pop(opponent.user_id, None)
+        if not bucket:
+            del self.buckets[entry.time_control]
+
+        return opponent
+
+    def start_game(self, first: QueueEntry, second: QueueEntry):
+        path, game = create_game()
+        game.set_mode(*first.time_control)
+
+        game.connect(first.websocket, first.user_id)
+        game.connect(second.websocket, second.user_id)
+
+        logger.info(f"matched {first.user_id} with {second.user_id} in {path}")
+
+        for entry in (first, second):
+            if not entry.future.done():
+                entry.future.set_result(path)
+
+
+matchmaker = Matchmaker()
@@ -7,6 +7,19 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger(__name__)
 
+MAX_NESTED_DEPTH = 1
+
+
+class InvalidMove(Exception):
+    pass
+
+
+def parse_coordinate(data: dict, key: str) -> int:
+    value = data.get(key)
+    if type(value) is not int or not 1 <= value <= 8:
+        raise InvalidMove(f"Invalid coordinate {key}")
+    return value
+
 
 class PieceMove:
     piece: "BasePiece"
@@ -39,26 +52,36 @@ class PieceMove:
         return self.piece, self.takes, self.x, self.y
 
     @staticmethod
-    def from_dict(data: dict, game: "ChessGame") -> "PieceMove" or None:
-        piece = game.find_piece_id(data["piece"])
+    def from_dict(data: dict, game: "ChessGame", depth: int = 0) -> "PieceMove":
+        if not isinstance(data, dict):
+            raise InvalidMove("Invalid move")
+
+        x = parse_coordinate(data, "x")
+        y = parse_coordinate(data, "y")
+
+        piece_id = data.get("piece")
+        piece = game.find_piece_id(piece_id) if isinstance(piece_id, str) else None
 
         if not piece:
-            raise Exception("Invalid piece")  # TODO raise invalid move
+            raise InvalidMove("Invalid piece")
 
         takes = None
-        if "takes" in data:
-            takes = game.find_piece_id(data["takes"])
+        if data.get("takes") is not None:
+            takes_id = data["takes"]
+            takes = game.find_piece_id(takes_id) if isinstance(takes_id, str) else None
 
             if not takes:
-                raise Exception("Invalid piece")  # TODO raise invalid move
+                raise InvalidMove("Invalid piece")
 
         nested = None
-        if "nested" in data and data["nested"]:
-            nested = PieceMove.from_dict(data["nested"], game)
+        if data.get("nested"):
+            if depth >= MAX_NESTED_DEPTH:
+                raise InvalidMove("Invalid nested move")
+            nested = PieceMove.from_dict(data["nested"], game, depth + 1)
 
-        logger.info(f'move from dict {piece} {takes} {data["x"]} {data["y"]} {nested}')
+        logger.info(f"move from dict {piece} {takes} {x} {y} {nested}")
 
-        return PieceMove(piece, data["x"], data["y"], takes, nested)
+        return PieceMove(piece, x, y, takes, nested)
 
     def perform(self, game: "ChessGame") -> bool:
         if not self.is_possible():
@@ -83,4 +106,4 @@ class PieceMove:
         return True
 
     def is_possible(self):
-        return self in self.piece.get_possible_moves()
+        return self in self.piece.game.get_possible_moves(self.piece)
@@ -17,12 +17,16 @@ class PlayerColor(GetValueEnum):
 
 
 class Player:
+    RTT_SMOOTHING = 0.125
+
     game: "ChessGame"
     user_id: str
     socket: Union[WebSocketServerProtocol, None]
     state: PlayerState
     color: PlayerColor
     remaining_time: float = 360  # TODO set from actual game length
+    premove: Union[dict, None] = None
+    rtt: Union[float, None] = None
 
     def __init__(
         self,
@@ -61,6 +65,12 @@ class Player:
         self.remaining_time = self.game.total_length
         self.send_state()
 
+    def record_rtt(self, rtt: float):
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += self.RTT_SMOOTHING * (rtt - self.rtt)
+
     @property
     def can_start(self):
         return self.state.value == PlayerState.CONNECTED
@@ -77,14 +87,39 @@ class Player:
                             "color": self.color.value,
                             "state": self.state.value,
                             "remaining_time": self.remaining_time,
+                            "premove": self.premove,
                         },
                     ),
                 )
             )
 
+    def to_snapshot(self) -> dict:
+        return {
+            "user_id": self.user_id,
+            "color": self.color.value,
+            "remaining_time": self.remaining_time,
+            "rtt": self.rtt,
+            "premove": self.premove,
+        }
+
+    @staticmethod
+    def from_snapshot(game, data: dict) -> "Player":
+        player = Player(
+            game,
+            data["user_id"],
+            PlayerColor.get_value(data["color"]),
+            data["remaining_time"],
+            None,
+        )
+        player.state = PlayerState.DISCONNECTED
+        player.rtt = data["rtt"]
+        player.premove = data["premove"]
+        return player
+
     def get_public_state_dict(self):
         return {
             "color": self.color.value,
             "remaining_time": self.remaining_time,
             "state": self.state.value,
+            "rtt": self.rtt,
         }
@@ -9,17 +9,52 @@ if __name__ == "__main__":
 
 import os
 import asyncio
+import json
+import signal
+import time
 
 from asyncio import sleep
+from typing import Callable, List, Set
 
 import websockets
 from websockets import WebSocketServerProtocol
 
-from actions import ActionReceiver
-from game import get_game
+from admin import ADMIN_PORT, start_admin_server
+from actions import (
+    MAX_MESSAGE_SIZE,
+    MAX_PER_MOVE,
+    MAX_TOTAL_LENGTH,
+    RATE_LIMIT_BURST,
+    RATE_LIMIT_RATE,
+    ActionReceiver,
+    ClientAction,
+    InvalidAction,
+    MultiplexReceiver,
+    ServerAction,
+    parse_int,
+    parse_user_id,
+)
+from game import (
+    ChessGame,
+    ServerDraining,
+    get_game,
+    is_draining,
+    paths,
+    restore_games,
+    start_draining,
+)
+from handoff import receive_snapshots, serve_snapshots
+from matchmaking import AlreadyQueued, matchmaker
+from rate_limit import TokenBucket
+from utils import get_message, tag_message
 
 HOST = os.environ.get("WEBSOCKET_HOST", "localhost")
 PORT = os.environ.get("PORT", 9000)
+RTT_PING_INTERVAL = float(os.environ.get("RTT_PING_INTERVAL", 5))
+LOBBY_PATH = os.environ.get("LOBBY_PATH", "/lobby")
+MULTIPLEX_PATH = os.environ.get("MULTIPLEX_PATH", "/multiplex")
+
+multiplexed_sockets: Set[WebSocketServerProtocol] = set()
 
 
 async def consumer_handler(websocket, path):
@@ -28,33 +63,176 @@ async def consumer_handler(websocket, path):
     await action_receiver.listen()
 
 
+async def send_messages(game: ChessGame):
+    messages, game.message_queue = game.message_queue, []
+
+    for socket, message in messages:
+        logger.info(f"sending message {message}")
+
+        for recipient in [socket] if socket else game.get_recipients():
+            if recipient in multiplexed_sockets:
+                outgoing = tag_message(message, game.path)
+            else:
+                outgoing = message
+
+            try:
+                await recipient.send(outgoing)
+            except websockets.ConnectionClosed:
+                pass
+
+
 async def producer_handler(websocket: WebSocketServerProtocol, path: str):
     game = get_game(path)
 
     while True:
         await sleep(0.1)
+        await send_messages(game)
 
-        for socket, message in game.message_queue:
-            logger.info(f"sending message {message}")
 
-            if not socket:
-                for player in game.players.values():
-                    if player.socket:
-                        await player.socket.send(message)
-            else:
-                await socket.send(message)
+async def multiplex_producer_handler(receiver: MultiplexReceiver):
+    while True:
+        await sleep(0.1)
+
+        for game in receiver.games:
+            await send_messages(game)
+
+
+async def ping_handler(
+    websocket: WebSocketServerProtocol, get_games: Callable[[], List[ChessGame]]
+):
+    while True:
+        await sleep(RTT_PING_INTERVAL)
+
+        try:
+            sent_at = time.monotonic()
+            pong_waiter = await websocket.ping()
+            await pong_waiter
+        except websockets.ConnectionClosed:
+            return
+
+        for game in get_games():
+            game.record_rtt(websocket, time.monotonic() - sent_at)
+
+
+async def lobby_handler(websocket: WebSocketServerProtocol):
+    rate_limiter = TokenBucket(RATE_LIMIT_RATE, RATE_LIMIT_BURST)
+
+    async for message in websocket:
+        if not rate_limiter.consume():
+            continue
+
+        try:
+            action, data = json.loads(message)
+            if ClientAction.get_value(action) != ClientAction.QUEUE:
+                raise InvalidAction("Unknown action")
+
+            user_id = parse_user_id(data)
+            total_length = parse_int(
+                data, "total_length", ChessGame.total_length, 1, MAX_TOTAL_LENGTH
+            )
+            per_move = parse_int(data, "per_move", ChessGame.per_move, 0, MAX_PER_MOVE)
+            rating = parse_int(data, "rating", 1500, 0, 5000)
+            break
+        except (AttributeError, RecursionError, TypeError, ValueError, InvalidAction):
+            logger.error("Invalid message, skipping")
+            await websocket.send(
+                get_message(ServerAction.ERROR, {"message": "Invalid message"})
+            )
+    else:
+        return None
+
+    try:
+        entry = matchmaker.enqueue(websocket, user_id, total_length, per_move, rating)
+    except AlreadyQueued:
+        await websocket.send(
+            get_message(ServerAction.ERROR, {"message": "Already queued"})
+        )
+        return None
+    except ServerDraining:
+        await websocket.close(1013, "Server is restarting")
+        return None
 
-        game.message_queue = []
+    closed = asyncio.ensure_future(websocket.wait_closed())
+    await asyncio.wait([entry.future, closed], return_when=asyncio.FIRST_COMPLETED)
+    closed.cancel()
+
+    if not entry.future.done():
+        matchmaker.cancel(entry)
+        return None
+
+    path = entry.future.result()
+    if path is None:
+        await websocket.close(1013, "Server is restarting")
+        return None
+
+    await websocket.send(get_message(ServerAction.MATCH_FOUND, {"path": path}))
+
+    return path
+
+
+async def multiplex_handler(websocket: WebSocketServerProtocol):
+    receiver = MultiplexReceiver(websocket, get_game)
+    multiplexed_sockets.add(websocket)
+
+    consumer_task = asyncio.ensure_future(receiver.listen())
+    producer_task = asyncio.ensure_future(multiplex_producer_handler(receiver))
+    ping_task = asyncio.ensure_future(ping_handler(websocket, lambda: receiver.games))
+
+    try:
+        done, pending = await asyncio.wait(
+            [consumer_task, producer_task, ping_task],
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        for task in pending:
+            task.cancel()
+    finally:
+        receiver.unsubscribe_all()
+        multiplexed_sockets.discard(websocket)
+
+
+async def drain(websocket_server):
+    if is_draining():
+        return
+
+    logger.info("draining, handing games off to the replacement process")
+
+    snapshots = start_draining()
+    matchmaker.drain()
+
+    for game in list(paths.values()):
+        game.send_reconnect()
+        await send_messages(game)
+
+    websocket_server.close()
+    await websocket_server.wait_closed()
+
+    if snapshots:
+        await serve_snapshots(snapshots)
+
+    asyncio.get_event_loop().stop()
 
 
 async def handler(websocket, path):
     logger.info(f"connected {websocket} {path}")
 
+    if is_draining():
+        await websocket.close(1013, "Server is restarting")
+        return None
+
+    if path == MULTIPLEX_PATH:
+        return await multiplex_handler(websocket)
+
+    if path == LOBBY_PATH:
+        path = await lobby_handler(websocket)
+        if path is None:
+            return None
+
     consumer_task = asyncio.ensure_future(consumer_handler(websocket, path))
     producer_task = asyncio.ensure_future(producer_handler(websocket, path))
+    ping_task = asyncio.ensure_future(ping_handler(websocket, lambda: [get_game(path)]))
 
     done, pending = await asyncio.wait(
-        [consumer_task, producer_task], return_when=asyncio.FIRST_COMPLETED
+        [consumer_task, producer_task, ping_task], return_when=asyncio.FIRST_COMPLETED,
     )
     for task in pending:
         game = get_game(path, False)
@@ -70,7 +248,15 @@ if __name__ == "__main__":
 
     logger.info(f"Starting server on {HOST}:{PORT}")
 
-    start_server = websockets.serve(handler, HOST, PORT)
+    restore_games(receive_snapshots())
+
+    start_server = websockets.serve(handler, HOST, PORT, max_size=MAX_MESSAGE_SIZE)
+
+    websocket_server = asyncio.get_event_loop().run_until_complete(start_server)
+    asyncio.get_event_loop().add_signal_handler(
+        signal.SIGTERM, lambda: asyncio.ensure_future(drain(websocket_server))
+    )
 
-    asyncio.get_event_loop().run_until_complete(start_server)
+    if ADMIN_PORT:
+        asyncio.get_event_loop().run_until_complete(start_admin_server())
     asyncio.get_event_loop().run_forever()
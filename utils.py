@@ -1,12 +1,28 @@
 import enum
 import json
+import time
+from contextlib import contextmanager
 
 
 def get_message(action: "ServerAction", message: dict):
     return json.dumps([action.value, message])
 
 
+def tag_message(message: str, tag: str):
+    # Appends the tag to an already serialized [action, data] message
+    return f"{message[:-1]}, {json.dumps(tag)}]"
+
+
 class GetValueEnum(enum.Enum):
     @classmethod
     def get_value(cls, value):
         return cls._value2member_map_.get(value, None)
+
+
+@contextmanager
+def timed(timings: dict, name: str):
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - started_at